@@ -40,7 +40,10 @@ int ezcmd_add_char(struct ezcmd_inst_s *inst, char c)
 void ezcmd_whitelines_to_nulls(struct ezcmd_inst_s *inst)
 {
   // TODO quotes disable conversion
-  for (size_t i = 0; i < inst->buffersize; i++)
+
+  /* Everything past the cursor is already null, only scan what was typed */
+
+  for (size_t i = 0; i < inst->cursor_pos; i++)
   {
     char c = inst->buffer[i];
     if (c == ' ')
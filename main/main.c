@@ -28,23 +28,22 @@
  *****************************************************************************/
 
 #include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
 #include "bsp/device.h"
 #include "bsp/display.h"
 #include "bsp/input.h"
 #include "console.h"
 #include "driver/gpio.h"
-#include "driver/uart.h"
 #include "esp_lcd_panel_ops.h"
 #include "esp_lcd_types.h"
 #include "esp_log.h"
 #include "freertos/idf_additions.h"
 #include "hal/lcd_types.h"
-#include "hal/usb_serial_jtag_hal.h"
 #include "nvs_flash.h"
 #include "pax_fonts.h"
 #include "pax_gfx.h"
 #include "pax_text.h"
-#include "console.h"
 #include "driver/usb_serial_jtag.h"
 #include "ezcmd2.h"
 
@@ -57,8 +56,10 @@
  *****************************************************************************/
 
 #define ERRC ESP_ERROR_CHECK
-#define BUF_SIZE (1024*16)
 #define LINE_BUF_SIZE 128
+#define ACM_OUT_BUF_SIZE 512
+#define ACM_IN_BUF_SIZE 2048 /* Bigger transfers, fewer callbacks and redraws */
+#define ACM_MAX_INTERFACES 10
 
 /******************************************************************************
  * Types
@@ -68,7 +69,14 @@ enum term_output_mode_e
 {
   TERM_OUTPUT_CRLF = 0,
   TERM_OUTPUT_CR = 1,
-  TERM_OUTPUT_LF = 2
+  TERM_OUTPUT_LF = 2,
+  TERM_OUTPUT_COUNT
+};
+
+struct main_cmd_s
+{
+  const char *name;
+  void (*handler)(struct ezcmd_inst_s *ez);
 };
 
 /******************************************************************************
@@ -80,18 +88,26 @@ static size_t g_disp_h = 0;
 static size_t g_disp_v = 0;
 static lcd_color_rgb_pixel_format_t g_disp_color_format;
 static pax_buf_t g_pax_buf = {0};
-struct cons_insts_s g_con_insts;
-static FILE *g_stdout_f;
-char g_isb_buff[BUF_SIZE];
+static struct cons_insts_s g_con_insts;
 static QueueHandle_t g_input_event_queue = NULL;
-char g_linebuffer[LINE_BUF_SIZE];
+static char g_linebuffer[LINE_BUF_SIZE];
 
-unsigned long g_baudrate = 115200;
-bool g_usb_connected = false;
-enum term_output_mode_e g_term_output_mode = 0;
-int g_term_stopbits = 0;
-int g_term_parity = 0;
-int g_term_databits = 8;
+static unsigned long g_baudrate = 115200;
+static bool g_usb_connected = false;
+static int g_acm_interface = 0;
+static enum term_output_mode_e g_term_output_mode = 0;
+static int g_term_stopbits = 0;
+static int g_term_parity = 0;
+static int g_term_databits = 8;
+
+/* Line ending sent on return, indexed by output mode */
+
+static const char *const g_term_line_endings[TERM_OUTPUT_COUNT] =
+{
+  [TERM_OUTPUT_CRLF] = "\r\n",
+  [TERM_OUTPUT_CR] = "\r",
+  [TERM_OUTPUT_LF] = "\n"
+};
 
 /******************************************************************************
  * Private Functions
@@ -99,10 +115,13 @@ int g_term_databits = 8;
 
 char get_key()
 {
-  /* Get keyboard events from BSP */
+  /* Get keyboard events from BSP. Block on the queue for a while so the
+   * caller does not have to spin, but wake up often enough to notice
+   * a disconnect.
+   */
 
   bsp_input_event_t event;
-  int ret = xQueueReceive(g_input_event_queue, &event, pdMS_TO_TICKS(1));
+  int ret = xQueueReceive(g_input_event_queue, &event, pdMS_TO_TICKS(10));
   if (ret == pdFALSE)
   {
     return 0;
@@ -251,8 +270,8 @@ void main_acmcdc()
 {
   const cdc_acm_host_device_config_t dev_config = {
     .connection_timeout_ms = 100,
-    .out_buffer_size = 512,
-    .in_buffer_size = 512,
+    .out_buffer_size = ACM_OUT_BUF_SIZE,
+    .in_buffer_size = ACM_IN_BUF_SIZE,
     .user_arg = NULL,
     .event_cb = handle_acmevent,
     .data_cb = handle_acmrx
@@ -270,25 +289,37 @@ void main_acmcdc()
 
   console_printf(&g_con_insts, "Scanning for ACM-CDC interface..."); main_draw();
 
-  int interface = 0;
+  /* Serial settings do not change while scanning, build them once */
+
+  const cdc_acm_line_coding_t line_coding = {
+    .dwDTERate = g_baudrate,
+    .bDataBits = g_term_databits,
+    .bParityType = g_term_parity,
+    .bCharFormat = g_term_stopbits
+  };
+
+  /* Start at the interface that worked last time, so reconnecting to the
+   * same device does not walk every interface again
+   */
+
+  int interface = g_acm_interface;
   for (;;)
   {
     vTaskDelay(1);
-    interface++;
-    interface = interface % 10;
 
     esp_err_t err = cdc_acm_host_open(CDC_HOST_ANY_VID, CDC_HOST_ANY_PID, interface, &dev_config, &cdc_dev);
-    if (err != ESP_OK) continue;
-    cdc_acm_line_coding_t line_coding;
-    line_coding.dwDTERate = g_baudrate;
-    line_coding.bDataBits = g_term_databits;
-    line_coding.bParityType = g_term_parity;
-    line_coding.bCharFormat = g_term_stopbits;      
-    err = cdc_acm_host_line_coding_set(cdc_dev, &line_coding);
-    if (err != ESP_OK) continue;
-    break;
+    if (err == ESP_OK)
+    {
+      err = cdc_acm_host_line_coding_set(cdc_dev, &line_coding);
+      if (err == ESP_OK) break;
+      cdc_acm_host_close(cdc_dev);
+    }
+
+    interface = (interface + 1) % ACM_MAX_INTERFACES;
   }
 
+  g_acm_interface = interface;
+
   console_printf(&g_con_insts, "\nConnected\n"); main_draw();
 
   /* Output loop */
@@ -296,40 +327,17 @@ void main_acmcdc()
   g_usb_connected = 1;
   while (g_usb_connected)
   {
-    vTaskDelay(1);
     char c = get_key();
 
     /* Handle special chars */
 
     /* Returns */
 
-    if (c == '\n')
+    if (c == '\n' && (unsigned)g_term_output_mode < TERM_OUTPUT_COUNT)
     {
-      switch (g_term_output_mode)
-      {
-        case TERM_OUTPUT_CRLF:
-        {
-          c = '\r';
-          cdc_acm_host_data_tx_blocking(cdc_dev, (uint8_t *)&c,1, 100);
-          c = '\n';
-          cdc_acm_host_data_tx_blocking(cdc_dev, (uint8_t *)&c,1, 100);
-          continue;
-        }
-
-        case TERM_OUTPUT_CR:
-        {
-          c = '\r';
-          cdc_acm_host_data_tx_blocking(cdc_dev, (uint8_t *)&c,1, 100);
-          continue;
-        }   
-        
-        case TERM_OUTPUT_LF:
-        {
-          c = '\n';
-          cdc_acm_host_data_tx_blocking(cdc_dev, (uint8_t *)&c,1, 100);
-          continue;
-        }        
-      }
+      const char *eol = g_term_line_endings[g_term_output_mode];
+      cdc_acm_host_data_tx_blocking(cdc_dev, (const uint8_t *)eol, strlen(eol), 100);
+      continue;
     }
 
     if (c > 0)
@@ -347,7 +355,7 @@ void main_acmcdc()
 
 /* Commands ******************************************************************/
 
-void main_cmd_help()
+void main_cmd_help(struct ezcmd_inst_s *ez)
 {
   console_printf(&g_con_insts, "help.           Shows this\n");
   console_printf(&g_con_insts, "baud {x}.       Sets the baudrate (default 115200)\n");
@@ -362,54 +370,59 @@ void main_cmd_help()
 
 }
 
-void main_cmd_stopbits(struct ezcmd_inst_s *ez)
+/* Reads the next argument as a number. Returns false if there is none */
+
+bool main_cmd_get_ulong(struct ezcmd_inst_s *ez, unsigned long *value)
 {
   char *arg = ezcmd_iterate_arguments(ez);
-  if (arg == NULL) return;
+  if (arg == NULL) return false;
+
+  *value = strtoul(arg, NULL, 0);
+  return true;
+}
+
+void main_cmd_stopbits(struct ezcmd_inst_s *ez)
+{
+  unsigned long value;
+  if (!main_cmd_get_ulong(ez, &value)) return;
 
-  int stops = strtoul(arg, NULL, 0);
-  g_term_stopbits = stops;
+  g_term_stopbits = value;
   console_printf(&g_con_insts, "stopbits set to %d\n", g_term_stopbits);
 }
 
 void main_cmd_databits(struct ezcmd_inst_s *ez)
 {
-  char *arg = ezcmd_iterate_arguments(ez);
-  if (arg == NULL) return;
+  unsigned long value;
+  if (!main_cmd_get_ulong(ez, &value)) return;
 
-  int databits = strtoul(arg, NULL, 0);
-  g_term_databits = databits;
+  g_term_databits = value;
   console_printf(&g_con_insts, "databits set to %d\n", g_term_databits);
 }
 
 void main_cmd_parity(struct ezcmd_inst_s *ez)
 {
-  char *arg = ezcmd_iterate_arguments(ez);
-  if (arg == NULL) return;
+  unsigned long value;
+  if (!main_cmd_get_ulong(ez, &value)) return;
 
-  int parity = strtoul(arg, NULL, 0);
-  g_term_parity = parity;
+  g_term_parity = value;
   console_printf(&g_con_insts, "parity set to %d\n", g_term_parity);
 }
 
 
 void main_cmd_output_mode(struct ezcmd_inst_s *ez)
 {
-  char *arg = ezcmd_iterate_arguments(ez);
-  if (arg == NULL) return;
+  unsigned long value;
+  if (!main_cmd_get_ulong(ez, &value)) return;
 
-  enum term_output_mode_e outmode = strtoul(arg, NULL, 0);
-  g_term_output_mode = outmode;
-  console_printf(&g_con_insts, "output set to %lu\n", g_term_output_mode);
+  g_term_output_mode = value;
+  console_printf(&g_con_insts, "output set to %lu\n", value);
 }
 
 
 void main_cmd_baud(struct ezcmd_inst_s *ez)
 {
-  char *arg = ezcmd_iterate_arguments(ez);
-  if (arg == NULL) return;
+  if (!main_cmd_get_ulong(ez, &g_baudrate)) return;
 
-  g_baudrate = strtoul(arg, NULL, 0);
   console_printf(&g_con_insts, "Baudrate set to %lu\n", g_baudrate);
 }
 
@@ -418,6 +431,19 @@ void main_cmd_start(struct ezcmd_inst_s *ez)
   main_acmcdc();
 }
 
+/* Command table, looked up by main_parse_cmd */
+
+static const struct main_cmd_s g_cmds[] =
+{
+  {"help", main_cmd_help},
+  {"baud", main_cmd_baud},
+  {"start", main_cmd_start},
+  {"parity", main_cmd_parity},
+  {"stopbits", main_cmd_stopbits},
+  {"bits", main_cmd_databits},
+  {"outmode", main_cmd_output_mode}
+};
+
 void main_parse_cmd(struct ezcmd_inst_s *ez)
 {
   /* Get command */
@@ -425,38 +451,16 @@ void main_parse_cmd(struct ezcmd_inst_s *ez)
   char *cmd = ezcmd_iterate_arguments(ez);
   if (cmd == NULL) return;
 
-  if (!strcmp(cmd, "help"))
-  {
-    main_cmd_help();
-  }
-  else if (!strcmp(cmd, "baud"))
-  {
-    main_cmd_baud(ez);
-  }
-  else if (!strcmp(cmd, "start"))
-  {
-    main_cmd_start(ez);
-  }
-  else if(!strcmp(cmd, "parity"))
-  {
-    main_cmd_parity(ez);
-  }
-  else if(!strcmp(cmd, "stopbits"))
-  {
-    main_cmd_stopbits(ez);
-  }
-  else if(!strcmp(cmd, "bits"))
-  {
-    main_cmd_databits(ez);
-  }
-  else if(!strcmp(cmd, "outmode"))
+  for (size_t i = 0; i < sizeof(g_cmds) / sizeof(g_cmds[0]); i++)
   {
-    main_cmd_output_mode(ez);
-  }
-  else{
-    console_printf(&g_con_insts, "Unknown command\n");
+    if (!strcmp(cmd, g_cmds[i].name))
+    {
+      g_cmds[i].handler(ez);
+      return;
+    }
   }
 
+  console_printf(&g_con_insts, "Unknown command\n");
 }
 
 /* Handle key inputs */
@@ -499,6 +503,10 @@ void main_inputlogic()
       continue;
     }
 
+    /* Only events that touch the console need a redraw */
+
+    bool redraw = false;
+
     switch (event.type)
     {
       case INPUT_EVENT_TYPE_KEYBOARD:
@@ -512,6 +520,7 @@ void main_inputlogic()
           console_printf(&g_con_insts, "\b ");
         }
         main_onkey(&ez, c);
+        redraw = true;
         break;
       }
 
@@ -527,7 +536,7 @@ void main_inputlogic()
         {
           console_printf(&g_con_insts, "\n");
           main_onkey(&ez, '\r');
-          
+          redraw = true;
           break;
         }
 
@@ -545,7 +554,10 @@ void main_inputlogic()
       }
     }
 
-    main_draw();
+    if (redraw)
+    {
+      main_draw();
+    }
   }
 
 }
@@ -611,7 +623,7 @@ void app_main( void )
 
   /* Show commands */
 
-  main_cmd_help();
+  main_cmd_help(NULL);
   main_draw();
 
   for(;;)